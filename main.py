@@ -1,58 +1,259 @@
-from fastapi import FastAPI, Request, Form
-from twilio.rest import Client
-from datetime import datetime, timedelta
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import ORJSONResponse
+from datetime import datetime
 import anthropic
+import httpx
 import os
 from dotenv import load_dotenv
-from collections import defaultdict
+from collections import defaultdict, deque, Counter, OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from bisect import bisect_left, bisect_right
+from itertools import islice
+import asyncio
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import sqlite3
+import time
 import re
-import json
+import secrets
+import orjson
 
 # Load environment variables (for local testing)
 load_dotenv()
 
-app = FastAPI(title="WhatsApp Summarizer Bot")
+# Per-message logs are DEBUG; set LOG_LEVEL=WARNING in production to skip them entirely
+LOG_FORMAT = "%(asctime)s %(levelname)s %(message)s"
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger("summarizer")
+logger.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+
+# Records are formatted on the caller's thread (QueueHandler.prepare) but written to stderr
+# by a listener thread, so the event loop never blocks on log I/O
+log_queue = queue.SimpleQueue()
+log_output = logging.StreamHandler()
+log_output.setFormatter(logging.Formatter(LOG_FORMAT))
+log_listener = QueueListener(log_queue, log_output)
+logger.addHandler(QueueHandler(log_queue))
+logger.propagate = False
+# Running from import (not the lifespan) so scripts and the uvicorn supervisor get their logs too
+log_listener.start()
+atexit.register(log_listener.stop)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start background workers on startup, stop them on shutdown"""
+    workers = [asyncio.create_task(command_worker()) for _ in range(COMMAND_WORKERS)]
+    workers.append(asyncio.create_task(last_read_purge_worker()))
+    if BATCH_MODE:
+        workers.append(asyncio.create_task(digest_batch_worker()))
+    yield
+    for worker in workers:
+        worker.cancel()
+    await twilio_http.aclose()
+
+
+app = FastAPI(title="WhatsApp Summarizer Bot", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # Initialize clients
-twilio_client = Client(
-    os.getenv('TWILIO_ACCOUNT_SID'),
-    os.getenv('TWILIO_AUTH_TOKEN')
+# Twilio's REST API called directly over one async keep-alive (HTTP/2) connection pool
+TWILIO_MESSAGES_URL = f"https://api.twilio.com/2010-04-01/Accounts/{os.getenv('TWILIO_ACCOUNT_SID')}/Messages.json"
+twilio_http = httpx.AsyncClient(
+    auth=(os.getenv('TWILIO_ACCOUNT_SID') or '', os.getenv('TWILIO_AUTH_TOKEN') or ''),
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=50),
+    timeout=float(os.getenv('TWILIO_TIMEOUT_SECONDS', 10))
 )
-anthropic_client = anthropic.Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY'))
+anthropic_client = anthropic.AsyncAnthropic(api_key=os.getenv('ANTHROPIC_API_KEY'))
 
 # Configuration
 SANDBOX_MODE = os.getenv('SANDBOX_MODE', 'true').lower() == 'true'
 SANDBOX_GROUP_ID = "group_test"
+TWILIO_FROM = os.getenv('TWILIO_WHATSAPP_NUMBER')
 MAX_TOKENS_PER_SUMMARY = 8000
-ESTIMATED_CHARS_PER_TOKEN = 4
+ESTIMATED_CHARS_PER_TOKEN = 4  # ASCII text; other characters are counted as a token each
+MESSAGE_TOKEN_OVERHEAD = 2  # ": " and the newline around each transcript line
+# Estimates are calibrated against the real input token counts Claude reports back
+TOKEN_SCALE_SMOOTHING = 0.2  # weight of the newest real/estimated ratio
+TOKEN_SCALE_MIN, TOKEN_SCALE_MAX = 0.5, 3.0
+INTENT_CACHE_SIZE = 1024
+COMMAND_WORKERS = int(os.getenv('COMMAND_WORKERS', 4))  # max commands talking to Claude/Twilio at once
+MAX_MESSAGES_PER_GROUP = 2000
+SUMMARY_CACHE_TTL_SECONDS = 60
+SUMMARY_FAILED_TEXT = "❌ Failed to generate summary. Please try again."
+SUMMARY_MODEL = "claude-sonnet-4-20250514"
+# Backlogs over MAX_TOKENS_PER_SUMMARY are summarized in at most MAX_SUMMARY_CHUNKS chunks
+# by the fast model, then merged
+CHUNK_MODEL = "claude-3-5-haiku-20241022"
+MAX_SUMMARY_CHUNKS = 6
+
+# Twilio POSTs run straight from the caller, at most this many at once
+MAX_CONCURRENT_SENDS = 50  # matches the Twilio keep-alive pool
+
+# Last-read marks untouched for this long are forgotten (checked every few hours)
+LAST_READ_TTL_SECONDS = 30 * 24 * 3600
+LAST_READ_PURGE_INTERVAL_SECONDS = 6 * 3600
+
+# Batch mode: digests go through the Message Batches API (50% cheaper, not interactive)
+BATCH_MODE = os.getenv('BATCH_MODE', 'false').lower() == 'true'
+# /digest is only served to callers sending this in the X-Digest-Token header (disabled when unset)
+DIGEST_TOKEN = os.getenv('DIGEST_TOKEN')
+BATCH_INTERVAL_SECONDS = int(os.getenv('BATCH_INTERVAL_SECONDS', 60))
+BATCH_POLL_SECONDS = 30
+
+# Timestamps are integer epoch nanoseconds (time.time_ns()) in memory and in SQLite
+NS_PER_SECOND = 1_000_000_000
+
+# Rolling windows for time filters ("today" is calendar-based, "all" has no cutoff)
+TIME_FILTER_WINDOWS = {
+    "last_hour": 3600 * NS_PER_SECOND,
+    "last_2_hours": 2 * 3600 * NS_PER_SECOND,
+    "last_day": 24 * 3600 * NS_PER_SECOND,
+}
+
+TIME_RANGE_TEXT = {
+    "today": "from today",
+    "last_hour": "from last hour",
+    "last_2_hours": "from last 2 hours",
+    "last_day": "from last 24 hours",
+    "all": ""
+}
+
+# Pre-compiled regexes used on every command (mention patterns run on casefolded text)
+_MENTION_RE = re.compile(r'@\w+\s*')
+_BOT_WORD_RE = re.compile(r'\bbot\b\s*')
+_JSON_FENCE_RE = re.compile(r'```json\n?|\n?```')
+_WHITESPACE_RE = re.compile(r'\s+')
+_BOT_TRIGGERS_RE = re.compile(r'@bot|@summarizer|hey bot|bot summarize|summarize')
 
-# Data storage (use database in production)
-group_messages = defaultdict(list)
-user_last_read = defaultdict(dict)
+# Common commands resolved without calling Claude (checked in order, so
+# time windows win over the generic "catch me up")
+PATTERN_CACHE = [
+    # Bare trigger, e.g. "@bot" alone, "summary" or "/sum" in the sandbox
+    (re.compile(r"^/?(summari[sz]e|summary|sum)?$"),
+     {"action": "summarize", "time_filter": "all", "from_last_read": True}),
+    (re.compile(r"\b(from|since) (my |the )?last read\b|\b(left off|where i left|caught up)\b"),
+     {"action": "summarize", "time_filter": "all", "from_last_read": True}),
+    (re.compile(r"\btoday\b"),
+     {"action": "summarize", "time_filter": "today", "from_last_read": False}),
+    (re.compile(r"\blast (1 |one |an )?hour\b"),
+     {"action": "summarize", "time_filter": "last_hour", "from_last_read": False}),
+    (re.compile(r"\blast (2|two) hours\b"),
+     {"action": "summarize", "time_filter": "last_2_hours", "from_last_read": False}),
+    (re.compile(r"\blast (day|24 hours)\b"),
+     {"action": "summarize", "time_filter": "last_day", "from_last_read": False}),
+    # Plain "catch me up" only - with any other time phrase ("last 3 hours", "yesterday") Claude decides
+    (re.compile(r"^(?!.*\b(last|hours?|days?|yesterday|week|month|minutes?)\b).*\bcatch (me )?up\b"),
+     {"action": "summarize", "time_filter": "all", "from_last_read": True}),
+]
 
-print(f"🚀 Bot starting in {'SANDBOX' if SANDBOX_MODE else 'PRODUCTION'} mode")
+# Data storage
+# SQLite is the source of truth, so history survives restarts and is shared by every worker
+db = sqlite3.connect(os.getenv('DATABASE_PATH', 'messages.db'), check_same_thread=False)
+# WAL lets workers read while another one writes; NORMAL only fsyncs at checkpoints
+db.executescript("""
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    group_id TEXT NOT NULL,
+    author TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    text TEXT NOT NULL,
+    ts INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_group_id ON messages (group_id, id);
+CREATE TABLE IF NOT EXISTS last_read (
+    author TEXT NOT NULL,
+    group_id TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    PRIMARY KEY (author, group_id)
+);
+""")
+
+
+def message_column() -> deque:
+    """One field of a group's messages; maxlen drops the oldest message in O(1)"""
+    return deque(maxlen=MAX_MESSAGES_PER_GROUP)
+
+
+@dataclass
+class GroupLog:
+    """
+    In-memory copy of a group's newest messages, caught up from SQLite by row id
+    Structure of arrays: index i across the columns is message i, so hot scans
+    (bisect on timestamps, token walks over texts) only touch the column they need
+    """
+    ids: deque = field(default_factory=message_column)
+    authors: deque = field(default_factory=message_column)
+    senders: deque = field(default_factory=message_column)
+    texts: deque = field(default_factory=message_column)
+    timestamps: deque = field(default_factory=message_column)
+    # Estimated tokens of every message appended before message i (prefix sums, never rebased),
+    # so messages i..newest cost token_total - token_offsets[i]
+    token_offsets: deque = field(default_factory=message_column)
+    token_total: int = 0
+    sender_counts: Counter = field(default_factory=Counter)  # sender -> messages held
+    
+    def append(self, row_id: int, author: str, sender_name: str, text: str, timestamp: int):
+        """Append one message, evicting the oldest once the group is full"""
+        
+        # Keep sender counts in step with the columns
+        if len(self.senders) == MAX_MESSAGES_PER_GROUP:
+            evicted = self.senders[0]
+            self.sender_counts[evicted] -= 1
+            if not self.sender_counts[evicted]:
+                del self.sender_counts[evicted]
+        self.sender_counts[sender_name] += 1
+        
+        self.ids.append(row_id)
+        self.authors.append(author)
+        self.senders.append(sender_name)
+        self.texts.append(text)
+        self.timestamps.append(timestamp)
+        self.token_offsets.append(self.token_total)
+        self.token_total += estimate_tokens(sender_name) + estimate_tokens(text) + MESSAGE_TOKEN_OVERHEAD
+
+
+group_messages = defaultdict(GroupLog)
+
+logger.info("🚀 Bot starting in %s mode", 'SANDBOX' if SANDBOX_MODE else 'PRODUCTION')
 
 
 # Add this global variable at the top with other globals
 last_requester = {}  # {group_id: phone_number}
+command_queue = asyncio.Queue()  # (handler, args) waiting for a command worker
+digest_queue = asyncio.Queue()  # (group_id, time_filter) waiting for the next batch
+send_slots = asyncio.Semaphore(MAX_CONCURRENT_SENDS)  # Twilio POSTs in flight
+intent_cache = OrderedDict()  # {normalized command: intent}, LRU order
+intent_inflight = {}  # {normalized command: Claude parse task} shared by concurrent identical commands
+token_scale = 1.0  # real / estimated input tokens, learned from summary responses
+summary_cache = {}  # {(group_id, first message id, last message id): (created, summary)}
+summary_inflight = {}  # {summary cache key: future} shared by identical concurrent requests
+
+WEBHOOK_ACK = b'{"status":"received"}'  # pre-encoded, the webhook answers every message with it
+
 
-@app.post("/webhook")
-async def whatsapp_webhook(
-    From: str = Form(...),
-    Body: str = Form(...),
-    ProfileName: str = Form(None),
-    To: str = Form(...),
-    WaId: str = Form(None),
-    Author: str = Form(None),
-    GroupId: str = Form(None)
-):
+@app.post("/webhook", status_code=202)
+async def whatsapp_webhook(request: Request):
     """
     Receives all WhatsApp messages from groups and DMs
+    Replies (Claude + Twilio) are queued for the command workers so Twilio gets its answer right away
     """
     
-    user_phone = From
-    message_text = Body.strip()
-    sender_name = ProfileName or "Unknown"
+    # Parse the Twilio form once and read every field from it
+    form = await request.form()
+    user_phone = form.get("From")
+    body = form.get("Body")
+    if user_phone is None or body is None:
+        return ORJSONResponse({"detail": "From and Body are required"}, status_code=422)
+    
+    message_text = body.strip()
+    message_folded = message_text.casefold()  # commands and mention checks only ever need this
+    sender_name = form.get("ProfileName") or "Unknown"
     
     # Handle Sandbox vs Production mode
     if SANDBOX_MODE:
@@ -60,48 +261,60 @@ async def whatsapp_webhook(
         author = user_phone
         group_id = SANDBOX_GROUP_ID
         is_group_message = True
-        print(f"📱 [SANDBOX] From: {sender_name} ({user_phone}): {message_text}")
+        logger.debug("📱 [SANDBOX] From: %s (%s): %s", sender_name, user_phone, message_text)
     else:
         # Production: Use actual WhatsApp Business API fields
-        author = Author or user_phone
-        group_id = GroupId or user_phone
-        is_group_message = GroupId is not None
-        print(f"📱 [PROD] Group: {group_id} | From: {sender_name} ({author}): {message_text}")
+        twilio_group_id = form.get("GroupId")
+        author = form.get("Author") or user_phone
+        group_id = twilio_group_id or user_phone
+        is_group_message = twilio_group_id is not None
+        logger.debug("📱 [PROD] Group: %s | From: %s (%s): %s", group_id, sender_name, author, message_text)
     
     # Check if bot is mentioned
-    bot_mentioned = is_bot_mentioned(message_text)
+    bot_mentioned = is_bot_mentioned(message_folded)
     
     # Handle different message types
     if SANDBOX_MODE:
         # SANDBOX: Check for commands first, then store as group messages
-        message_lower = message_text.lower()
-        
-        if message_lower in ['help', '/help']:
-            handle_dm_command(user_phone, message_text)
-        elif bot_mentioned or message_lower in ['summary', '/summary', '/sum']:
+        if message_folded in ['help', '/help']:
+            command_queue.put_nowait((handle_dm_command, (user_phone, message_folded)))
+        elif bot_mentioned or message_folded in ['summary', '/summary', '/sum']:
             # Store who requested the summary
             last_requester[group_id] = user_phone
             
             # Treat as summary request
             if bot_mentioned:
-                command = remove_bot_mention(message_text)
+                command = remove_bot_mention(message_folded)
             else:
-                command = message_text
-            await handle_group_command(group_id, author, sender_name, command, user_phone)
+                command = message_folded
+            command_queue.put_nowait((handle_group_command, (group_id, author, sender_name, command, user_phone)))
         else:
             # Regular message - store it
             store_group_message(group_id, author, sender_name, message_text)
     else:
         # PRODUCTION: Normal flow
         if bot_mentioned and is_group_message:
-            command = remove_bot_mention(message_text)
-            await handle_group_command(group_id, author, sender_name, command, user_phone)
+            command = remove_bot_mention(message_folded)
+            command_queue.put_nowait((handle_group_command, (group_id, author, sender_name, command, user_phone)))
         elif is_group_message:
             store_group_message(group_id, author, sender_name, message_text)
         else:
-            handle_dm_command(user_phone, message_text)
+            command_queue.put_nowait((handle_dm_command, (user_phone, message_folded)))
     
-    return {"status": "received"}
+    return Response(WEBHOOK_ACK, media_type="application/json", status_code=202)
+
+
+async def command_worker():
+    """Run queued command handlers one at a time (COMMAND_WORKERS of these run side by side)"""
+    
+    while True:
+        handler, args = await command_queue.get()
+        try:
+            await handler(*args)
+        except Exception as e:
+            logger.error("❌ %s failed: %s", handler.__name__, e)
+        finally:
+            command_queue.task_done()
 
 
 async def handle_group_command(group_id: str, author: str, sender_name: str, command: str, requester_phone: str):
@@ -110,19 +323,19 @@ async def handle_group_command(group_id: str, author: str, sender_name: str, com
     Mentions the person who requested it
     """
     
-    print(f"🔍 Parsing command: {command}")
+    logger.debug("🔍 Parsing command: %s", command)
     
     # Parse the command using Claude
     intent = await parse_command_intent(command)
     
-    print(f"✅ Intent: {intent}")
+    logger.info("✅ Intent: %s", intent)
     
     if intent['action'] == 'summarize':
         time_filter = intent.get('time_filter', 'all')
         from_last_read = intent.get('from_last_read', False)
         
         # Generate summary
-        summary = generate_group_summary(
+        summary = await generate_group_summary(
             group_id, 
             author, 
             time_filter, 
@@ -133,13 +346,13 @@ async def handle_group_command(group_id: str, author: str, sender_name: str, com
         reply = f"@{sender_name}\n\n{summary}"
         
         # In sandbox, send directly to requester
-        send_group_message(group_id, reply, requester_phone)
+        await send_group_message(group_id, reply, requester_phone)
         
         # Update last read for this user
-        user_last_read[author][group_id] = datetime.now()
+        set_last_read(author, group_id, time.time_ns())
     
     else:
-        send_group_message(group_id, 
+        await send_group_message(group_id, 
             f"@{sender_name} I didn't understand that. Try:\n"
             "• 'summarize today's chat'\n"
             "• 'summarize from last read'\n"
@@ -147,54 +360,38 @@ async def handle_group_command(group_id: str, author: str, sender_name: str, com
             requester_phone)
 
 
-def send_group_message(group_id: str, message: str, requester_phone: str = None):
+async def send_group_message(group_id: str, message: str, requester_phone: str = None):
     """Send message to the group (or user in sandbox mode)"""
     try:
         if SANDBOX_MODE:
             # In sandbox mode, send to the requester directly
             to_phone = requester_phone or last_requester.get(group_id)
             if not to_phone:
-                print("⚠️ No requester phone found, cannot send message")
+                logger.warning("⚠️ No requester phone found, cannot send message")
                 return
         else:
             # In production, send to the actual group
             to_phone = group_id
         
-        twilio_client.messages.create(
-            from_=os.getenv('TWILIO_WHATSAPP_NUMBER'),
-            to=to_phone,
-            body=message
-        )
-        print(f"✅ Sent to {to_phone}")
+        await send_whatsapp(to_phone, message)
+        logger.info("✅ Sent to %s", to_phone)
     except Exception as e:
-        print(f"❌ Failed to send message: {e}")
+        logger.error("❌ Failed to send message: %s", e)
 
 def is_bot_mentioned(message: str) -> bool:
-    """Check if bot is mentioned"""
-    message_lower = message.lower()
-    bot_triggers = ['@bot', '@summarizer', 'hey bot', 'bot summarize', 'summarize']
-    return any(trigger in message_lower for trigger in bot_triggers)
+    """Check if bot is mentioned (message is casefolded)"""
+    return _BOT_TRIGGERS_RE.search(message) is not None
 
 
 def remove_bot_mention(message: str) -> str:
-    """Remove bot mention to get actual command"""
-    message = re.sub(r'@\w+\s*', '', message, flags=re.IGNORECASE)
-    message = re.sub(r'\bbot\b\s*', '', message, flags=re.IGNORECASE)
-    return message.strip()
+    """Remove bot mention to get actual command (message is casefolded)"""
+    return _BOT_WORD_RE.sub('', _MENTION_RE.sub('', message)).strip()
 
 
 
 
 
-async def parse_command_intent(command: str) -> dict:
-    """Use Claude to parse natural language command"""
-    
-    try:
-        response = anthropic_client.messages.create(
-            model="claude-3-5-haiku-20241022",
-            max_tokens=200,
-            temperature=0,
-            system="""You are a command parser for a WhatsApp summarizer bot.
+INTENT_SYSTEM_PROMPT = """You are a command parser for a WhatsApp summarizer bot.
 Parse the user's command and return ONLY a JSON object:
 {
     "action": "summarize|help|unknown",
@@ -208,112 +405,239 @@ Examples:
 "what happened in last 2 hours" -> {"action": "summarize", "time_filter": "last_2_hours", "from_last_read": false}
 "summarize from my last read" -> {"action": "summarize", "time_filter": "all", "from_last_read": true}
 "summarize" -> {"action": "summarize", "time_filter": "all", "from_last_read": true}
-""",
-            messages=[{
-                "role": "user",
-                "content": f"Parse this command: {command}"
-            }]
-        )
-        
-        intent_text = response.content[0].text.strip()
-        intent_text = re.sub(r'```json\n?|\n?```', '', intent_text)
-        intent = json.loads(intent_text)
+"""
+
+
+def cached_system_prompt(text: str) -> list:
+    """System block marked for Anthropic prompt caching (reused across calls)"""
+    return [{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}]
+
+
+def normalize_command(command: str) -> str:
+    """Casefold and collapse whitespace so equivalent commands share a cache key"""
+    return _WHITESPACE_RE.sub(' ', command.casefold().strip())
+
+
+async def parse_command_intent(command: str) -> dict:
+    """Parse natural language command (pattern cache, then LRU cache, then Claude)"""
+    
+    normalized = normalize_command(command)
+    
+    intent = _fast_parse_intent(normalized)
+    if intent:
         return intent
     
+    cached = intent_cache.get(normalized)
+    if cached is not None:
+        intent_cache.move_to_end(normalized)
+        return dict(cached)
+    
+    # Identical commands arriving together wait on the same Claude call
+    pending = intent_inflight.get(normalized)
+    if pending is None:
+        pending = asyncio.ensure_future(_parse_intent_llm(normalized))
+        intent_inflight[normalized] = pending
+        pending.add_done_callback(lambda _: intent_inflight.pop(normalized, None))
+    
+    try:
+        # shield: one cancelled waiter mustn't cancel the call the others share
+        intent = await asyncio.shield(pending)
+    
     except Exception as e:
-        print(f"❌ Error parsing intent: {e}")
+        logger.error("❌ Error parsing intent: %s", e)
         return {"action": "unknown"}
+    
+    # Only successful parses are cached
+    intent_cache[normalized] = intent
+    if len(intent_cache) > INTENT_CACHE_SIZE:
+        intent_cache.popitem(last=False)
+    
+    return dict(intent)
 
 
-def generate_group_summary(group_id: str, author: str, time_filter: str, from_last_read: bool) -> str:
+def _fast_parse_intent(command: str):
+    """Rule-based parse of a normalized command (None when no rule matches)"""
+    
+    for pattern, intent in PATTERN_CACHE:
+        if pattern.search(command):
+            return dict(intent)
+    
+    return None
+
+
+async def _parse_intent_llm(command: str) -> dict:
+    """Use Claude to parse natural language command"""
+    
+    response = await anthropic_client.messages.create(
+        model="claude-3-5-haiku-20241022",
+        max_tokens=200,
+        temperature=0,
+        system=cached_system_prompt(INTENT_SYSTEM_PROMPT),
+        messages=[{
+            "role": "user",
+            "content": f"Parse this command: {command}"
+        }]
+    )
+    
+    intent_text = response.content[0].text.strip()
+    intent_text = _JSON_FENCE_RE.sub('', intent_text)
+    intent = orjson.loads(intent_text)
+    return intent
+
+
+async def generate_group_summary(group_id: str, author: str, time_filter: str, from_last_read: bool) -> str:
     """Generate summary for the group"""
     
-    if group_id not in group_messages or not group_messages[group_id]:
-        return "📝 No messages to summarize yet!"
+    group = sync_group(group_id)
     
-    all_messages = group_messages[group_id]
+    if not group or not group.texts:
+        return "📝 No messages to summarize yet!"
     
     # Filter messages
-    filtered_messages = filter_messages(all_messages, author, group_id, time_filter, from_last_read)
+    start = filter_messages(group, author, group_id, time_filter, from_last_read)
     
-    if not filtered_messages:
+    if start == len(group.texts):
         return f"📝 No messages found for '{time_filter}'"
     
-    # Apply token limit
-    filtered_messages = apply_token_limit(filtered_messages)
+    # Apply token limit - large backlogs are summarized hierarchically, so keep what
+    # MAX_SUMMARY_CHUNKS chunks hold and summarize exactly those
+    chunks = summary_chunks(group, start)
+    start = chunks[0][0]
     
-    # Generate summary
-    summary = generate_summary(filtered_messages, time_filter)
+    # Count before awaiting Claude - new messages may arrive meanwhile
+    msg_count = len(group.texts) - start
+    
+    # Reuse a recent summary of the same slice - ids identify it exactly, so different
+    # filters selecting the same messages share an entry and a new message changes the key
+    cache_key = (group_id, group.ids[start], group.ids[-1])
+    cached = summary_cache.get(cache_key)
+    
+    if cached and time.time() - cached[0] < SUMMARY_CACHE_TTL_SECONDS:
+        summary = cached[1]
+    else:
+        summary = await shared_summary(cache_key, group, chunks, time_filter)
+        if summary != SUMMARY_FAILED_TEXT:
+            cache_summary(cache_key, summary)
     
-    msg_count = len(filtered_messages)
     time_info = get_time_range_text(time_filter, from_last_read)
     
     return f"📝 *Summary* ({msg_count} messages {time_info}):\n\n{summary}"
 
 
-def filter_messages(messages: list, author: str, group_id: str, 
-                   time_filter: str, from_last_read: bool) -> list:
-    """Filter messages based on time and last read"""
+async def shared_summary(cache_key: tuple, group: GroupLog, chunks: list, time_filter: str) -> str:
+    """Generate the summary for cache_key once - identical requests arriving meanwhile wait for it"""
     
-    now = datetime.now()
+    pending = summary_inflight.get(cache_key)
+    if pending is not None:
+        # shield: one cancelled waiter mustn't cancel the summary the others share
+        return await asyncio.shield(pending)
+    
+    # Generated here rather than in a task so the slice is read before anything else runs
+    pending = summary_inflight[cache_key] = asyncio.get_running_loop().create_future()
+    summary = SUMMARY_FAILED_TEXT
+    try:
+        summary = await generate_summary(group, chunks[0][0], time_filter, chunks)
+    finally:
+        del summary_inflight[cache_key]
+        pending.set_result(summary)
+    
+    return summary
+
+
+def cache_summary(cache_key: tuple, summary: str):
+    """Store a summary and drop expired entries"""
+    
+    now = time.time()
+    expired = [key for key, (created, _) in summary_cache.items() if now - created >= SUMMARY_CACHE_TTL_SECONDS]
+    for key in expired:
+        del summary_cache[key]
+    
+    summary_cache[cache_key] = (now, summary)
+
+
+def filter_messages(group: GroupLog, author: str, group_id: str, 
+                   time_filter: str, from_last_read: bool) -> int:
+    """
+    Filter messages based on time and last read
+    Timestamps are sorted, so the result is always a suffix - returns its start index
+    """
+    
+    timestamps = group.timestamps
+    start = 0
     
     # Filter by last read if requested
     if from_last_read:
-        last_read_time = user_last_read.get(author, {}).get(group_id)
+        last_read_time = get_last_read(author, group_id)
         if last_read_time:
-            messages = [m for m in messages if m['timestamp'] > last_read_time]
+            start = bisect_right(timestamps, last_read_time)
         else:
             # No previous read - get last 50 messages
-            messages = messages[-50:] if len(messages) > 50 else messages
-    
-    # Filter by time
-    if time_filter == "today":
-        start_of_day = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        messages = [m for m in messages if m['timestamp'] >= start_of_day]
-    
-    elif time_filter == "last_hour":
-        cutoff = now - timedelta(hours=1)
-        messages = [m for m in messages if m['timestamp'] >= cutoff]
+            start = max(len(timestamps) - 50, 0)
     
-    elif time_filter == "last_2_hours":
-        cutoff = now - timedelta(hours=2)
-        messages = [m for m in messages if m['timestamp'] >= cutoff]
-    
-    elif time_filter == "last_day":
-        cutoff = now - timedelta(days=1)
-        messages = [m for m in messages if m['timestamp'] >= cutoff]
+    # Filter by time - one binary search from wherever last read left us
+    cutoff = get_time_filter_cutoff(time_filter)
+    if cutoff is not None:
+        start = bisect_left(timestamps, cutoff, start)
     
     elif time_filter == "all" and not from_last_read:
         # Get last 100 messages
-        messages = messages[-100:] if len(messages) > 100 else messages
+        start = max(len(timestamps) - 100, 0)
     
-    return messages
+    return start
 
 
-def apply_token_limit(messages: list) -> list:
-    """Truncate messages to fit token limit (keeps most recent)"""
+def get_time_filter_cutoff(time_filter: str):
+    """Oldest timestamp (epoch ns) included by time_filter (None if it has no cutoff)"""
     
-    total_chars = sum(len(m['sender']) + len(m['text']) for m in messages)
-    estimated_tokens = total_chars / ESTIMATED_CHARS_PER_TOKEN
+    if time_filter == "today":
+        midnight = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        return int(midnight.timestamp()) * NS_PER_SECOND
     
-    if estimated_tokens <= MAX_TOKENS_PER_SUMMARY:
-        return messages
+    window = TIME_FILTER_WINDOWS.get(time_filter)
+    return time.time_ns() - window if window else None
+
+
+def apply_token_limit(group: GroupLog, start: int, limit: int = MAX_TOKENS_PER_SUMMARY) -> int:
+    """Truncate messages to fit token limit (keeps most recent), returns the new start index"""
     
-    truncated = []
-    current_tokens = 0
+    total = len(group.texts)
     
-    for message in reversed(messages):
-        msg_chars = len(message['sender']) + len(message['text'])
-        msg_tokens = msg_chars / ESTIMATED_CHARS_PER_TOKEN
-        
-        if current_tokens + msg_tokens > MAX_TOKENS_PER_SUMMARY:
-            break
-        
-        truncated.insert(0, message)
-        current_tokens += msg_tokens
+    # Offsets increase with i, so the oldest message whose suffix fits is one binary search away;
+    # the newest message is always kept, even when it alone is over the limit
+    fit_start = bisect_left(group.token_offsets, group.token_total - token_budget(limit), start)
+    fit_start = min(fit_start, max(start, total - 1))
+    
+    if fit_start > start:
+        logger.warning("⚠️ Truncated %d → %d messages (token limit)", total - start, total - fit_start)
+    
+    return fit_start
+
+
+def token_budget(tokens: int) -> float:
+    """How many estimated tokens fit in tokens real ones (per token_scale)"""
+    return tokens / token_scale
+
+
+def calibrate_token_scale(estimated: int, usage):
+    """Move token_scale towards the real/estimated ratio of a finished request"""
+    global token_scale
     
-    print(f"⚠️ Truncated {len(messages)} → {len(truncated)} messages (token limit)")
-    return truncated
+    real = usage.input_tokens + (usage.cache_read_input_tokens or 0) + (usage.cache_creation_input_tokens or 0)
+    ratio = min(max(real / estimated, TOKEN_SCALE_MIN), TOKEN_SCALE_MAX)
+    token_scale += TOKEN_SCALE_SMOOTHING * (ratio - token_scale)
+    logger.debug("📏 Token scale %.2f (estimated %d, real %d)", token_scale, estimated, real)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Approximate Claude token count without a network call
+    ASCII averages ~4 chars per token; emoji, CJK and accented text run closer to a token per char
+    """
+    if text.isascii():
+        return -(-len(text) // ESTIMATED_CHARS_PER_TOKEN)
+    
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    return -(-ascii_chars // ESTIMATED_CHARS_PER_TOKEN) + len(text) - ascii_chars
 
 
 def get_time_range_text(time_filter: str, from_last_read: bool) -> str:
@@ -321,34 +645,10 @@ def get_time_range_text(time_filter: str, from_last_read: bool) -> str:
     if from_last_read:
         return "since your last read"
     
-    time_map = {
-        "today": "from today",
-        "last_hour": "from last hour",
-        "last_2_hours": "from last 2 hours",
-        "last_day": "from last 24 hours",
-        "all": ""
-    }
-    return time_map.get(time_filter, "")
+    return TIME_RANGE_TEXT.get(time_filter, "")
 
 
-def generate_summary(messages: list, time_filter: str) -> str:
-    """Generate AI summary using Claude"""
-    
-    # Format messages
-    chat_text = "\n".join([
-        f"{m['sender']}: {m['text']}" 
-        for m in messages
-    ])
-    
-    input_tokens = len(chat_text) / ESTIMATED_CHARS_PER_TOKEN
-    print(f"📊 Estimated input tokens: {int(input_tokens)}")
-    
-    try:
-        response = anthropic_client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=600,
-            temperature=0.7,
-            system="""You are a WhatsApp group summarizer. 
+SUMMARY_SYSTEM_PROMPT = """You are a WhatsApp group summarizer. 
 Create a concise, actionable summary focusing on:
 - Key decisions or announcements
 - Important questions (especially unanswered ones)
@@ -363,46 +663,327 @@ Format:
 - If someone was asked a question, mention it clearly
 - Keep it scannable and useful
 
-Do NOT include greetings, small talk, or irrelevant chatter.""",
-            messages=[{
-                "role": "user",
-                "content": f"Summarize this WhatsApp group chat:\n\n{chat_text}"
-            }]
-        )
+Do NOT include greetings, small talk, or irrelevant chatter."""
+
+SUMMARY_INSTRUCTION = "Summarize this WhatsApp group chat:\n\n"
+SUMMARY_PROMPT_TOKENS = estimate_tokens(SUMMARY_SYSTEM_PROMPT) + estimate_tokens(SUMMARY_INSTRUCTION)
+
+
+CHUNK_SYSTEM_PROMPT = """You are summarizing one part of a longer WhatsApp group chat.
+Write compact notes that keep every decision, announcement, question (and who asked it),
+action item and time-sensitive detail. Skip greetings and small talk."""
+
+
+def format_transcript(group: GroupLog, start: int, end: int = None) -> str:
+    """Messages start..end as "sender: text" lines"""
+    
+    # map + str.join stays in C, no intermediate list
+    return "\n".join(map(
+        "{}: {}".format,
+        islice(group.senders, start, end),
+        islice(group.texts, start, end)
+    ))
+
+
+def build_summary_params(group: GroupLog, start: int) -> dict:
+    """Claude request params for summarizing group messages from start on (shared by live and batch paths)"""
+    
+    chat_text = format_transcript(group, start)
+    
+    logger.debug("📊 Estimated input tokens: %d", group.token_total - group.token_offsets[start])
+    
+    return {
+        "model": SUMMARY_MODEL,
+        "max_tokens": 600,
+        "temperature": 0.7,
+        "system": cached_system_prompt(SUMMARY_SYSTEM_PROMPT),
+        "messages": [{
+            "role": "user",
+            "content": SUMMARY_INSTRUCTION + chat_text
+        }]
+    }
+
+
+async def generate_summary(group: GroupLog, start: int, time_filter: str, chunks: list = None) -> str:
+    """Generate AI summary using Claude (more than one chunk from summary_chunks is summarized hierarchically)"""
+    
+    estimated = group.token_total - group.token_offsets[start]
+    hierarchical = chunks is not None and len(chunks) > 1
+    
+    try:
+        if hierarchical:
+            params = await summarize_chunks(group, chunks)
+        else:
+            params = build_summary_params(group, start)
+        
+        response = await anthropic_client.messages.create(**params)
         
         usage = response.usage
-        print(f"📊 Tokens - Input: {usage.input_tokens}, Output: {usage.output_tokens}")
+        logger.info("📊 Tokens - Input: %s, Output: %s, Cache read: %s",
+                    usage.input_tokens, usage.output_tokens, usage.cache_read_input_tokens or 0)
+        
+        # A merge request carries chunk notes, not the transcript we estimated
+        if not hierarchical:
+            calibrate_token_scale(estimated + SUMMARY_PROMPT_TOKENS, usage)
         
         return response.content[0].text.strip()
     
     except Exception as e:
-        print(f"❌ Error: {e}")
-        return "❌ Failed to generate summary. Please try again."
+        logger.error("❌ Error: %s", e)
+        return SUMMARY_FAILED_TEXT
+
+
+def summary_chunks(group: GroupLog, start: int) -> list:
+    """
+    Split messages from start on into consecutive (start, end) ranges of at most MAX_TOKENS_PER_SUMMARY
+    tokens, oldest first - packed from the newest message, so at most MAX_SUMMARY_CHUNKS keep the most recent
+    """
+    
+    offsets = group.token_offsets
+    budget = token_budget(MAX_TOKENS_PER_SUMMARY)
+    end = len(offsets)
+    end_offset = group.token_total
+    chunks = []
+    
+    while end > start and len(chunks) < MAX_SUMMARY_CHUNKS:
+        # Oldest message that still fits with everything up to end (a chunk always takes one)
+        chunk_start = min(bisect_left(offsets, end_offset - budget, start, end), end - 1)
+        chunks.append((chunk_start, end))
+        end, end_offset = chunk_start, offsets[chunk_start]
+    
+    if end > start:
+        total = len(offsets)
+        logger.warning("⚠️ Truncated %d → %d messages (token limit)", total - start, total - end)
+    
+    chunks.reverse()
+    return chunks
+
+
+async def summarize_chunks(group: GroupLog, chunks: list) -> dict:
+    """Summarize each chunk with CHUNK_MODEL in parallel, returns the params for the merge request"""
+    
+    # Build every request before awaiting - new messages may shift the indices meanwhile
+    chunk_requests = [
+        anthropic_client.messages.create(
+            model=CHUNK_MODEL,
+            max_tokens=400,
+            system=cached_system_prompt(CHUNK_SYSTEM_PROMPT),
+            messages=[{"role": "user", "content": format_transcript(group, chunk_start, chunk_end)}]
+        )
+        for chunk_start, chunk_end in chunks
+    ]
+    logger.info("🧩 Summarizing %d chunks before merging", len(chunk_requests))
+    
+    responses = await asyncio.gather(*chunk_requests)
+    partials = "\n\n".join(
+        f"Part {n}:\n{response.content[0].text.strip()}"
+        for n, response in enumerate(responses, 1)
+    )
+    
+    return {
+        "model": SUMMARY_MODEL,
+        "max_tokens": 600,
+        "temperature": 0.7,
+        "system": cached_system_prompt(SUMMARY_SYSTEM_PROMPT),
+        "messages": [{
+            "role": "user",
+            "content": f"Merge these notes on consecutive parts of a WhatsApp group chat (oldest first) into one summary:\n\n{partials}"
+        }]
+    }
+
+
+async def send_digest(group_id: str, time_filter: str):
+    """Summarize a group and post the digest (non-batch mode, runs on a command worker)"""
+    
+    group = group_messages[group_id]
+    start = select_digest_messages(group_id, time_filter)
+    msg_count = len(group.texts) - start
+    if not msg_count:
+        return
+    
+    summary = await generate_summary(group, start, time_filter)
+    await send_group_message(group_id, format_digest(summary, msg_count, time_filter))
+
+
+def select_digest_messages(group_id: str, time_filter: str) -> int:
+    """Start index of the messages for a scheduled digest (time window only, no per-user last read)"""
+    
+    group = group_messages[group_id]
+    start = filter_messages(group, None, group_id, time_filter, False)
+    return apply_token_limit(group, start)
+
+
+def format_digest(summary: str, msg_count: int, time_filter: str) -> str:
+    """Digest reply posted to the group"""
+    time_info = get_time_range_text(time_filter, False)
+    return f"📝 *Digest* ({msg_count} messages {time_info}):\n\n{summary}"
+
+
+async def digest_batch_worker():
+    """Drain queued digests every BATCH_INTERVAL_SECONDS into one Message Batch"""
+    
+    while True:
+        await asyncio.sleep(BATCH_INTERVAL_SECONDS)
+        
+        jobs = {}
+        while not digest_queue.empty():
+            group_id, time_filter = digest_queue.get_nowait()
+            jobs[group_id] = time_filter
+        
+        if jobs:
+            try:
+                await run_digest_batch(jobs)
+            except Exception as e:
+                logger.error("❌ Digest batch failed: %s", e)
+
+
+async def run_digest_batch(jobs: dict):
+    """Submit one batch for {group_id: time_filter}, wait for it, then post the digests"""
+    
+    # custom_id only allows [a-zA-Z0-9_-], so map ids back to group ids
+    pending = {}
+    requests = []
+    for i, (group_id, time_filter) in enumerate(jobs.items()):
+        group = group_messages[group_id]
+        start = select_digest_messages(group_id, time_filter)
+        msg_count = len(group.texts) - start
+        if not msg_count:
+            continue
+        custom_id = f"digest-{i}"
+        pending[custom_id] = (group_id, time_filter, msg_count)
+        requests.append({"custom_id": custom_id, "params": build_summary_params(group, start)})
+    
+    if not requests:
+        return
+    
+    batch = await anthropic_client.messages.batches.create(requests=requests)
+    logger.info("📦 Submitted digest batch %s (%d groups)", batch.id, len(requests))
+    
+    while batch.processing_status != "ended":
+        await asyncio.sleep(BATCH_POLL_SECONDS)
+        batch = await anthropic_client.messages.batches.retrieve(batch.id)
+    
+    async for entry in await anthropic_client.messages.batches.results(batch.id):
+        group_id, time_filter, msg_count = pending[entry.custom_id]
+        if entry.result.type != "succeeded":
+            logger.warning("❌ Digest for %s %s", group_id, entry.result.type)
+            continue
+        summary = entry.result.message.content[0].text.strip()
+        await send_group_message(group_id, format_digest(summary, msg_count, time_filter))
+
+
+def store_group_message(group_id: str, author: str, sender_name: str, text: str,
+                        timestamp: int = None):
+    """Store a group message (callers storing a batch can pass one shared timestamp)"""
+    
+    timestamp = timestamp or time.time_ns()
+    
+    with db:
+        db.execute(
+            "INSERT INTO messages (group_id, author, sender, text, ts) VALUES (?, ?, ?, ?, ?)",
+            (group_id, author, sender_name, text, timestamp)
+        )
+    
+    group = sync_group(group_id)
+    
+    logger.debug("💾 Stored message in %s: %d total", group_id, len(group.texts))
 
 
-def store_group_message(group_id: str, author: str, sender_name: str, text: str):
-    """Store a group message"""
+def sync_group(group_id: str):
+    """
+    Append rows added since our newest cached one (by this or any other worker)
+    Returns the group's GroupLog, or None if the group has no messages
+    """
+    
+    group = group_messages.get(group_id)
+    last_id = group.ids[-1] if group and group.ids else 0
+    
+    rows = db.execute(
+        "SELECT id, author, sender, text, ts FROM messages "
+        "WHERE group_id = ? AND id > ? ORDER BY id DESC LIMIT ?",
+        (group_id, last_id, MAX_MESSAGES_PER_GROUP)
+    ).fetchall()
+    
+    if not rows:
+        return group
     
-    group_messages[group_id].append({
-        'author': author,
-        'sender': sender_name,
-        'text': text,
-        'timestamp': datetime.now()
-    })
+    group = group_messages[group_id]
+    evicted_id = None
+    
+    for row_id, author, sender_name, text, ts in reversed(rows):
+        if len(group.ids) == MAX_MESSAGES_PER_GROUP:
+            evicted_id = group.ids[0]
+        group.append(row_id, author, sender_name, text, ts)
+    
+    # Rows that fell out of the in-memory window are gone for good - keep the table bounded too
+    if evicted_id is not None:
+        with db:
+            db.execute("DELETE FROM messages WHERE group_id = ? AND id <= ?", (group_id, evicted_id))
+    
+    return group
+
+
+def sync_all_groups() -> list:
+    """Catch up every group in the database, returns the group ids"""
+    
+    group_ids = [row[0] for row in db.execute("SELECT DISTINCT group_id FROM messages")]
+    for group_id in group_ids:
+        sync_group(group_id)
+    return group_ids
+
+
+def get_last_read(author: str, group_id: str):
+    """When author last got a summary of group_id (None if never)"""
+    
+    row = db.execute(
+        "SELECT ts FROM last_read WHERE author = ? AND group_id = ?", (author, group_id)
+    ).fetchone()
+    return row[0] if row else None
+
+
+def set_last_read(author: str, group_id: str, timestamp: int):
+    """Record that author has read group_id up to timestamp"""
+    
+    with db:
+        db.execute(
+            "INSERT OR REPLACE INTO last_read (author, group_id, ts) VALUES (?, ?, ?)",
+            (author, group_id, timestamp)
+        )
+
+
+def count_last_read_users() -> int:
+    """Number of users with a recorded last read"""
+    return db.execute("SELECT COUNT(DISTINCT author) FROM last_read").fetchone()[0]
+
+
+def purge_last_read() -> int:
+    """Delete last-read marks older than LAST_READ_TTL_SECONDS, returns how many went"""
     
-    # Keep last 2000 messages per group
-    if len(group_messages[group_id]) > 2000:
-        group_messages[group_id] = group_messages[group_id][-2000:]
+    cutoff = time.time_ns() - LAST_READ_TTL_SECONDS * NS_PER_SECOND
+    with db:
+        return db.execute("DELETE FROM last_read WHERE ts < ?", (cutoff,)).rowcount
+
+
+async def last_read_purge_worker():
+    """Expire stale last-read marks every LAST_READ_PURGE_INTERVAL_SECONDS"""
     
-    print(f"💾 Stored message in {group_id}: {len(group_messages[group_id])} total")
+    while True:
+        try:
+            purged = purge_last_read()
+            if purged:
+                logger.info("🧹 Purged %d stale last-read marks", purged)
+        except Exception as e:
+            logger.error("❌ Last-read purge failed: %s", e)
+        
+        await asyncio.sleep(LAST_READ_PURGE_INTERVAL_SECONDS)
 
 
 
 
-def handle_dm_command(user_phone: str, message: str):
-    """Handle DM commands (help, info, etc)"""
+async def handle_dm_command(user_phone: str, message: str):
+    """Handle DM commands (help, info, etc) - message arrives casefolded"""
     
-    if 'help' in message.lower() or message.strip() == '/help':
+    if 'help' in message:
         help_text = """
 🤖 *WhatsApp Group Summarizer Bot*
 
@@ -426,27 +1007,53 @@ I'll reply directly in the group!
 
 Just mention me anytime in the group!
         """
-        send_dm(user_phone, help_text.strip())
+        await send_dm(user_phone, help_text.strip())
     
     else:
-        send_dm(user_phone, 
+        await send_dm(user_phone, 
             "👋 Hi! I'm a group summarizer bot.\n\n"
             "Add me to your WhatsApp groups and mention me:\n"
             "'@bot summarize today's chat'\n\n"
             "Type 'help' for more info!")
 
 
-def send_dm(to_phone: str, message: str):
+async def send_dm(to_phone: str, message: str):
     """Send DM to individual user"""
     try:
-        twilio_client.messages.create(
-            from_=os.getenv('TWILIO_WHATSAPP_NUMBER'),
-            to=to_phone,
-            body=message
-        )
-        print(f"✅ Sent DM to {to_phone}")
+        await send_whatsapp(to_phone, message)
+        logger.info("✅ Sent DM to %s", to_phone)
     except Exception as e:
-        print(f"❌ Failed to send DM: {e}")
+        logger.error("❌ Failed to send DM: %s", e)
+
+
+async def send_whatsapp(to_phone: str, message: str):
+    """Create a Twilio WhatsApp message (raises on HTTP errors)"""
+    async with send_slots:
+        response = await twilio_http.post(
+            TWILIO_MESSAGES_URL,
+            data={"From": TWILIO_FROM, "To": to_phone, "Body": message}
+        )
+    response.raise_for_status()
+
+
+@app.post("/digest", status_code=202)
+async def digest(request: Request, time_filter: str = "last_day"):
+    """Summarize every group (meant to be hit by a scheduler, e.g. a daily cron)"""
+    
+    # Each call costs a Claude summary and a post per group, so only the scheduler may trigger it
+    token = request.headers.get("X-Digest-Token", "")
+    if not DIGEST_TOKEN or not secrets.compare_digest(token.encode(), DIGEST_TOKEN.encode()):
+        return ORJSONResponse({"detail": "Invalid digest token"}, status_code=401)
+    
+    group_ids = sync_all_groups()
+    
+    for group_id in group_ids:
+        if BATCH_MODE:
+            digest_queue.put_nowait((group_id, time_filter))
+        else:
+            command_queue.put_nowait((send_digest, (group_id, time_filter)))
+    
+    return {"status": "queued", "groups": len(group_ids), "batch_mode": BATCH_MODE}
 
 
 @app.get("/")
@@ -460,9 +1067,9 @@ async def root():
 
 @app.get("/health")
 async def health():
-    """Health check with stats"""
-    total_messages = sum(len(msgs) for msgs in group_messages.values())
-    total_users = len(user_last_read)
+    """Health check with stats (this worker's in-memory counts - probes never catch up or prune groups)"""
+    total_messages = sum(len(group.texts) for group in group_messages.values())
+    total_users = count_last_read_users()
     
     return {
         "status": "healthy",
@@ -474,32 +1081,61 @@ async def health():
     }
 
 
+def format_timestamp(timestamp: int) -> str:
+    """ISO 8601 local time for an epoch-ns timestamp"""
+    return datetime.fromtimestamp(timestamp / NS_PER_SECOND).isoformat()
+
+
 @app.get("/stats")
 async def stats():
     """Get detailed statistics"""
-    group_stats = {}
+    per_group = {}
+    sync_all_groups()
     
-    for group_id, messages in group_messages.items():
-        senders = {}
-        for msg in messages:
-            sender = msg['sender']
-            senders[sender] = senders.get(sender, 0) + 1
+    for group_id, group in group_messages.items():
+        senders = group.sender_counts
         
-        group_stats[group_id] = {
-            "total_messages": len(messages),
+        timestamps = group.timestamps
+        per_group[group_id] = {
+            "total_messages": len(timestamps),
             "unique_senders": len(senders),
-            "top_sender": max(senders.items(), key=lambda x: x[1])[0] if senders else None,
-            "oldest_message": messages[0]['timestamp'].isoformat() if messages else None,
-            "newest_message": messages[-1]['timestamp'].isoformat() if messages else None
+            "top_sender": senders.most_common(1)[0][0] if senders else None,
+            "oldest_message": format_timestamp(timestamps[0]) if timestamps else None,
+            "newest_message": format_timestamp(timestamps[-1]) if timestamps else None
         }
     
     return {
-        "groups": group_stats,
-        "total_users": len(user_last_read)
+        "groups": per_group,
+        "total_users": count_last_read_users()
+    }
+
+
+
+@app.get("/stats/{group_id}")
+async def group_stats(group_id: str):
+    """Statistics for one group (sender counts are kept up to date on insert)"""
+    group = sync_group(group_id)
+    
+    if not group or not group.timestamps:
+        return ORJSONResponse({"detail": "Unknown group"}, status_code=404)
+    
+    return {
+        "group_id": group_id,
+        "total_messages": len(group.timestamps),
+        "unique_senders": len(group.sender_counts),
+        "top_senders": group.sender_counts.most_common(5),
+        "oldest_message": format_timestamp(group.timestamps[0]),
+        "newest_message": format_timestamp(group.timestamps[-1])
     }
 
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    # uvicorn picks uvloop + httptools itself when installed; workers share state through SQLite
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        workers=int(os.getenv("WORKERS", 2))
+    )
\ No newline at end of file